@@ -1,15 +1,197 @@
 import streamlit as st
 import re
 import io
-import google.generativeai as genai
-from docx import Document
+import csv
+import zipfile
 import os
-from datetime import datetime
+import hashlib
+import bisect
+import threading
+import diskcache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import json
+from lxml import etree
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 load_dotenv()
 
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_TEXT = W_NS + 't'
+W_PARAGRAPH = W_NS + 'p'
+W_RUN = W_NS + 'r'
+W_TAB = W_NS + 'tab'
+W_BREAK = W_NS + 'br'
+W_CR = W_NS + 'cr'
+W_TABLE = W_NS + 'tbl'
+W_BODY = W_NS + 'body'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+LLM_CACHE_DIR = ".llm_cache"
+
+# Long documents are split into overlapping windows detected in parallel
+DETECT_CHUNK_SIZE = 4000
+DETECT_CHUNK_OVERLAP = 400
+DETECT_MAX_WORKERS = 8
+
+# Only text around likely placeholders is sent for detection, joined by CANDIDATE_SEP
+CANDIDATE_RE = re.compile(r'\[[^\]]{1,80}\]|\{[^}]{1,80}\}|<[^>]{1,80}>|_{5,}|\b(?:INSERT|FILL IN|TBD)\b')
+CANDIDATE_CONTEXT = 80
+CANDIDATE_SEP = "\n---\n"
+
+# Response schemas Gemini's JSON output is held to. Plain dicts, because the SDK drops
+# the required list from schemas it derives from classes
+DETECT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'placeholders': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'label': {'type': 'string'},
+                    'original': {'type': 'string'},
+                    'description': {'type': 'string'},
+                    'position': {'type': 'integer'},
+                    'question': {'type': 'string'},
+                },
+                'required': ['label', 'original', 'description', 'position', 'question'],
+            },
+        },
+    },
+    'required': ['placeholders'],
+}
+VALIDATE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'valid': {'type': 'boolean'},
+        'feedback': {'type': 'string'},
+        'value': {'type': 'string'},
+    },
+    'required': ['valid', 'feedback', 'value'],
+}
+
+# Output budgets per call; JSON mode makes Gemini return bare JSON
+DETECT_CONFIG = {
+    'max_output_tokens': 2048, 'temperature': 0,
+    'response_mime_type': 'application/json', 'response_schema': DETECT_SCHEMA
+}
+QUESTION_CONFIG = {'max_output_tokens': 64, 'temperature': 0.3}
+QUESTIONS_CONFIG = {'max_output_tokens': 2048, 'temperature': 0.3, 'response_mime_type': 'application/json'}
+VALIDATE_CONFIG = {
+    'max_output_tokens': 512, 'temperature': 0,
+    'response_mime_type': 'application/json', 'response_schema': VALIDATE_SCHEMA
+}
+# Detection replies grow with the placeholders in an excerpt, up to the model's output limit
+DETECT_TOKENS_PER_CANDIDATE = 100
+DETECT_MAX_OUTPUT_TOKENS = 8192
+ANSWERS_CONFIG = {'max_output_tokens': 4096, 'temperature': 0, 'response_mime_type': 'application/json'}
+
+# Stream free-text replies into the page instead of waiting for the whole reply
+STREAM = True
+
+# Questions generated in the background for the fields after the current one, on a pool
+# shared by all sessions
+PREFETCH_AHEAD = 3
+PREFETCH_MAX_WORKERS = 4
+
+# Recently filled fields shown to Gemini when it phrases a question
+FILLED_CONTEXT = 5
+
+# Gemini context caching needs a large enough prompt; a cache this close to expiring is extended
+CONTEXT_CACHE_MIN_TOKENS = 32768
+CONTEXT_CACHE_TTL = timedelta(minutes=30)
+CONTEXT_CACHE_REFRESH = timedelta(minutes=5)
+
+# Parsed uploads, detected placeholders and Gemini replies (which echo the user's answers)
+# are kept this long
+UPLOAD_CACHE_TTL = timedelta(hours=1)
+
+_MONTH = r'(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?'
+
+_US_STATES = (
+    r'alabama|alaska|arizona|arkansas|california|colorado|connecticut|delaware|florida|georgia|hawaii|idaho'
+    r'|illinois|indiana|iowa|kansas|kentucky|louisiana|maine|maryland|massachusetts|michigan|minnesota'
+    r'|mississippi|missouri|montana|nebraska|nevada|new hampshire|new jersey|new mexico|new york'
+    r'|north carolina|north dakota|ohio|oklahoma|oregon|pennsylvania|rhode island|south carolina'
+    r'|south dakota|tennessee|texas|utah|vermont|virginia|washington|west virginia|wisconsin|wyoming'
+    r'|district of columbia'
+)
+# Postal codes only in capitals, so "ok" or "or" isn't read as a state
+_US_STATE_CODES = (
+    r'(?-i:AL|AK|AZ|AR|CA|CO|CT|DE|FL|GA|HI|ID|IL|IN|IA|KS|KY|LA|ME|MD|MA|MI|MN|MS|MO|MT|NE|NV|NH|NJ'
+    r'|NM|NY|NC|ND|OH|OK|OR|PA|RI|SC|SD|TN|TX|UT|VT|VA|WA|WV|WI|WY|DC)'
+)
+
+# Field category -> shape of an answer that needs no AI check
+_QUICK_PATTERNS = {
+    'email': re.compile(r'[^@\s]+@[^@\s]+\.[a-z]{2,}', re.I),
+    'date': re.compile(
+        rf'\d{{1,2}}[/.-]\d{{1,2}}[/.-]\d{{2,4}}|\d{{4}}-\d{{2}}-\d{{2}}'
+        rf'|{_MONTH}\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}}|\d{{1,2}}(?:st|nd|rd|th)?\s+{_MONTH},?\s+\d{{4}}',
+        re.I
+    ),
+    'amount': re.compile(r'(?:[$€£]\s?)?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d{1,2})?(?:\s?(?:usd|eur|gbp|dollars))?', re.I),
+    # Two or more capitalised words (connectors aside); anything else is left to Gemini
+    'name': re.compile(
+        r"(?=.{3,100}$)[A-Z][A-Za-z.,'&-]*"
+        r"(?:\s+(?:[A-Z][A-Za-z.,'&-]*|&|and|of|the|de|la|van|von|der|du))*\s+[A-Z][A-Za-z.,'&-]*"
+    ),
+    'state': re.compile(rf'(?:state of\s+)?(?:{_US_STATES})|{_US_STATE_CODES}', re.I),
+}
+
+# Answers that say there is no answer; never accepted locally
+_NON_ANSWER_RE = re.compile(
+    r"\b(?:n/?a|none|idk|unknown|tb[ad]|not sure|don'?t know|dunno|skip|later|nothing|null"
+    r"|not applicable|to be determined|no idea|blank|same as|(?:see|as) (?:above|below))\b",
+    re.I
+)
+
+# A date-shaped answer must also parse as a real day under one of these, after
+# ordinals, punctuation and long month names are normalised
+_DATE_FORMATS = ('%Y %m %d', '%m %d %Y', '%d %m %Y', '%m %d %y', '%d %m %y', '%b %d %Y', '%d %b %Y')
+_ORDINAL_RE = re.compile(r'(?<=\d)(?:st|nd|rd|th)\b', re.I)
+
+# Field category <- words in its label, tried in this order; a bare "cap" is not an amount
+_CATEGORY_RES = {
+    'email': re.compile(r'\be-?mail', re.I),
+    'date': re.compile(r'\bdate', re.I),
+    'amount': re.compile(r'\b(?:amount|price|fee|sum|valuation)\b', re.I),
+    'name': re.compile(r'\bname', re.I),
+    'state': re.compile(r'\b(?:state|jurisdiction)\b', re.I),
+}
+
+# Labels that say nothing about the answer, so the description decides the category
+_GENERIC_LABELS = {'blank', 'field', 'value', 'entry', 'input', 'text', 'placeholder', 'information', 'details'}
+
+_LABEL_RE = re.compile(r'[^a-z0-9]')
+
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'style.css')
+
+UPLOAD_BANNER = """
+<div class="upload-section">
+    <h2>📤 Upload Document</h2>
+    <p>AI will identify all placeholders</p>
+</div>
+"""
+
+SUCCESS_BANNER = """
+<div class="success-box">
+    <h1>✅ Complete!</h1>
+    <p>Your document is ready</p>
+</div>
+"""
+
 st.set_page_config(
     page_title="Legal Document Processor",
     page_icon="📄",
@@ -17,92 +199,38 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-st.markdown("""
-<style>
-    .main { padding: 0rem 1rem; }
-    .stButton>button {
-        width: 100%;
-        border-radius: 10px;
-        height: 3em;
-        font-weight: 600;
-        background-color: #007bff;
-        color: white;
-    }
-    .upload-section {
-        border: 2px dashed #4CAF50;
-        border-radius: 10px;
-        padding: 2rem;
-        text-align: center;
-        background-color: #f0f8ff;
-    }
-    .chat-message {
-        padding: 1rem;
-        border-radius: 10px;
-        margin-bottom: 1rem;
-    }
-    .user-message {
-        background-color: #007bff;
-        color: white;
-        margin-left: 20%;
-    }
-    .assistant-message {
-        background-color: #e9ecef;
-        color: #212529;
-        margin-right: 20%;
-    }
-    .placeholder-box {
-        padding: 0.8rem;
-        border-radius: 8px;
-        margin-bottom: 0.5rem;
-        border-left: 4px solid;
-    }
-    .completed { background-color: #d4edda; border-color: #28a745; color: #155724; }
-    .current { background-color: #cce5ff; border-color: #007bff; color: #004085; }
-    .pending { background-color: #f8f9fa; border-color: #dee2e6; color: #6c757d; }
-    .success-box {
-        padding: 1.5rem;
-        border-radius: 10px;
-        background-color: #d4edda;
-        border: 2px solid #28a745;
-        text-align: center;
-    }
-    .doc-preview {
-        background-color: #ffffff;
-        padding: 1.5rem;
-        border-radius: 10px;
-        border: 2px solid #dee2e6;
-        max-height: 500px;
-        overflow-y: auto;
-        font-family: 'Courier New', monospace;
-        white-space: pre-wrap;
-        color: #212529;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-# Initialize ALL session state variables first
-if 'step' not in st.session_state:
-    st.session_state.step = 'upload'
-if 'placeholders' not in st.session_state:
-    st.session_state.placeholders = []
-if 'filled_data' not in st.session_state:
-    st.session_state.filled_data = {}
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
-if 'current_index' not in st.session_state:
-    st.session_state.current_index = 0
-if 'document_text' not in st.session_state:
-    st.session_state.document_text = ""
-if 'file_name' not in st.session_state:
-    st.session_state.file_name = ""
-if 'completed_doc' not in st.session_state:
-    st.session_state.completed_doc = ""
-if 'api_configured' not in st.session_state:
-    st.session_state.api_configured = False
-if 'waiting_for_clarification' not in st.session_state:
-    st.session_state.waiting_for_clarification = False
-if 'model_name' not in st.session_state:
-    st.session_state.model_name = None
+@st.cache_resource(show_spinner=False)
+def load_css(path):
+    """Read the stylesheet once per process"""
+    with open(path, encoding='utf-8') as f:
+        return f"<style>{f.read()}</style>"
+
+# Styles must be emitted on every rerun; Streamlit drops elements a run doesn't repeat
+st.html(load_css(CSS_PATH))
+
+# Initialize ALL session state variables first; the literals are rebuilt each run,
+# so sessions never share these objects
+_DEFAULTS = {
+    'step': 'upload',
+    'placeholders': [],
+    'placeholder_columns': {'key': [], 'label': [], 'original': []},
+    'filled_data': {},
+    'messages': [],
+    'current_index': 0,
+    'document_text': "",
+    'file_name': "",
+    'api_configured': False,
+    'waiting_for_clarification': False,
+    'model_name': None,
+    'doc_cache': None,
+    'doc_cache_expires': None,
+    'doc_cache_refreshing': False,
+    'doc_cache_lock': threading.Lock(),
+    'questions': {},
+    'prefetching': {},
+}
+for key, value in _DEFAULTS.items():
+    st.session_state.setdefault(key, value)
 
 # Get API key
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
@@ -112,74 +240,318 @@ if not GEMINI_API_KEY:
     except:
         pass
 
-# Configure API once
-if GEMINI_API_KEY and not st.session_state.api_configured:
+@st.cache_resource(show_spinner=False)
+def get_model(name):
+    """Build a GenerativeModel once per process"""
+    import google.generativeai as genai
+    return genai.GenerativeModel(name)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Open the on-disk Gemini reply cache once per process"""
+    return diskcache.Cache(LLM_CACHE_DIR)
+
+@st.cache_resource(show_spinner=False)
+def get_cached_model(cache_name):
+    """Build a model bound to a cached document once per process"""
+    import google.generativeai as genai
+    return genai.GenerativeModel.from_cached_content(cache_name)
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """Thread pool shared by every session for background Gemini calls"""
+    return ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS)
+
+def submit_in_context(fn, *args):
+    """Run fn on the shared pool with this script run's context, so it can read session state"""
+    ctx = get_script_run_ctx()
+    
+    def task():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    
+    return get_executor().submit(task)
+
+def create_document_cache(text, model_name):
+    """Upload the document to Gemini's context cache; None if it is too small or caching fails"""
+    # ~4 characters per token; below the minimum the document is sent inline
+    if len(text) // 4 < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+    try:
+        import google.generativeai as genai
+        cache = genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction="You help fill in the placeholders of the legal document provided as context.",
+            contents=[text],
+            ttl=CONTEXT_CACHE_TTL
+        )
+        return cache.name
+    except Exception:
+        return None
+
+def cache_document(text):
+    """Put the document in Gemini's context cache for this session, if it qualifies"""
+    if st.session_state.doc_cache:
+        delete_document_cache(st.session_state.doc_cache)
+    st.session_state.doc_cache = create_document_cache(text, st.session_state.model_name)
+    st.session_state.doc_cache_expires = datetime.now() + CONTEXT_CACHE_TTL
+
+def document_cache():
+    """Name of this session's document cache, kept alive past its TTL; None to send context inline"""
+    # The session's lock only decides which thread refreshes; the others carry on with
+    # the current name, and no one holds it over a network call
+    with st.session_state.doc_cache_lock:
+        name = st.session_state.doc_cache
+        due = (
+            name and not st.session_state.doc_cache_refreshing
+            and datetime.now() >= st.session_state.doc_cache_expires - CONTEXT_CACHE_REFRESH
+        )
+        if due:
+            st.session_state.doc_cache_refreshing = True
+    if not due:
+        return name
+    
+    try:
+        import google.generativeai as genai
+        genai.caching.CachedContent.get(name).update(ttl=CONTEXT_CACHE_TTL)
+        st.session_state.doc_cache_expires = datetime.now() + CONTEXT_CACHE_TTL
+    except Exception:
+        # Already expired or deleted: upload the document again
+        cache_document(st.session_state.document_text)
+    finally:
+        st.session_state.doc_cache_refreshing = False
+    return st.session_state.doc_cache
+
+def delete_document_cache(name):
+    """Delete a document cache now rather than paying for it until it expires"""
+    try:
+        import google.generativeai as genai
+        genai.caching.CachedContent.get(name).delete()
+    except Exception:
+        pass
+
+def generate_text(model_name, prompt, config=None, cache_name=None, stream_to=None, parse=None):
+    """Return Gemini's reply to prompt, reusing an earlier reply; streams into stream_to if given.
+    
+    With parse, the parsed reply is returned instead, and replies parse rejects are never cached.
+    """
+    cache = get_response_cache()
+    settings = sorted((config or {}).items())
+    key = hashlib.blake2b(f"{cache_name or model_name}\n{settings}\n{prompt}".encode(), digest_size=16).hexdigest()
+    text = cache.get(key)
+    if text is not None:
+        return parse(text) if parse else text
+    
+    model = get_cached_model(cache_name) if cache_name else get_model(model_name)
+    if STREAM and stream_to is not None:
+        text = ""
+        for chunk in model.generate_content(prompt, generation_config=config, stream=True):
+            text += chunk.text
+            stream_to.markdown(text)
+    else:
+        text = model.generate_content(prompt, generation_config=config).text
+    result = parse(text) if parse else text
+    cache.set(key, text, expire=UPLOAD_CACHE_TTL.total_seconds())
+    return result
+
+def probe_model(model_name):
+    """Check that model_name answers a trivial prompt"""
+    try:
+        get_model(model_name).generate_content("test")
+        return True
+    except Exception:
+        return False
+
+@st.cache_resource(show_spinner=False)
+def configure_api(api_key):
+    """Configure Gemini and pick a model once per process"""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    
+    # List available models from API
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
+        available_models = []
+        for model in genai.list_models():
+            if 'generateContent' in model.supported_generation_methods:
+                available_models.append(model.name)
+    except Exception as list_error:
+        # Fallback: try common model names directly
+        model_options = [
+            'gemini-1.5-flash',
+            'gemini-1.5-pro',
+            'gemini-2.0-flash-exp',
+            'gemini-pro'
+        ]
         
-        # List available models from API
+        # Probe them concurrently and keep whichever answers first
+        executor = ThreadPoolExecutor(max_workers=len(model_options))
+        futures = {executor.submit(probe_model, name): name for name in model_options}
         try:
-            available_models = []
-            for model in genai.list_models():
-                if 'generateContent' in model.supported_generation_methods:
-                    available_models.append(model.name)
-            
-            if available_models:
-                # Use the first available model
-                st.session_state.model_name = available_models[0]
-                st.session_state.api_configured = True
-            else:
-                st.error("No generative models available with this API key")
-        except Exception as list_error:
-            # Fallback: try common model names directly
-            model_options = [
-                'gemini-1.5-flash',
-                'gemini-1.5-pro',
-                'gemini-2.0-flash-exp',
-                'gemini-pro'
-            ]
-            
-            for model_name in model_options:
-                try:
-                    test_model = genai.GenerativeModel(model_name)
-                    test_model.generate_content("test")
-                    st.session_state.model_name = model_name
-                    st.session_state.api_configured = True
-                    break
-                except:
-                    continue
-            
-            if not st.session_state.api_configured:
-                st.error(f"Could not configure API. Error: {str(list_error)}")
-            
+            for future in as_completed(futures):
+                if future.result():
+                    return futures[future]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        raise RuntimeError(f"Could not configure API. Error: {str(list_error)}")
+    
+    if not available_models:
+        raise RuntimeError("No generative models available with this API key")
+    
+    # Use the first available model
+    return available_models[0]
+
+# Configure API once
+if GEMINI_API_KEY and not st.session_state.api_configured:
+    try:
+        st.session_state.model_name = configure_api(GEMINI_API_KEY)
+        st.session_state.api_configured = True
+    except RuntimeError as e:
+        st.error(str(e))
     except Exception as e:
         st.error(f"API configuration failed: {str(e)}")
 
+def stream_docx_text(file):
+    """Extract paragraph text by streaming word/document.xml out of the zip"""
+    full_text = []
+    # Runs of each open paragraph; text-box paragraphs nest inside another one
+    paragraphs = []
+    fallback_depth = 0
+    tags = (W_PARAGRAPH, W_TABLE, W_TEXT, W_TAB, W_BREAK, W_CR, MC_FALLBACK)
+    with zipfile.ZipFile(file) as z, z.open('word/document.xml') as xml:
+        # lxml hands back only these elements, so the loop never sees the rest
+        for event, elem in etree.iterparse(xml, events=('start', 'end'), tag=tags):
+            if elem.tag == MC_FALLBACK:
+                # Text boxes are stored twice; the fallback copy repeats the mc:Choice one
+                fallback_depth += 1 if event == 'start' else -1
+            elif fallback_depth:
+                pass
+            elif event == 'start':
+                if elem.tag == W_PARAGRAPH:
+                    paragraphs.append([])
+            elif elem.tag == W_PARAGRAPH:
+                # Empty paragraphs are kept; they are the spacing of the completed document
+                full_text.append(''.join(paragraphs.pop()))
+            elif paragraphs:
+                # Same text python-docx gives: tabs and line breaks become \t and \n
+                runs = paragraphs[-1]
+                if elem.tag == W_TEXT:
+                    if elem.text:
+                        runs.append(elem.text)
+                elif elem.tag == W_TAB:
+                    # w:tab also defines tab stops in paragraph properties
+                    if elem.getparent().tag == W_RUN:
+                        runs.append('\t')
+                elif elem.tag == W_CR or (
+                    elem.tag == W_BREAK and elem.get(W_NS + 'type', 'textWrapping') == 'textWrapping'
+                ):
+                    # Page and column breaks carry no text
+                    runs.append('\n')
+            if event == 'end':
+                elem.clear()
+                # Cleared elements stay in the tree; drop the body's finished blocks too
+                if elem.tag in (W_PARAGRAPH, W_TABLE) and elem.getparent().tag == W_BODY:
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+    return '\n'.join(full_text)
+
 def parse_docx(file):
     """Parse DOCX file and extract text"""
     try:
+        return stream_docx_text(file)
+    except Exception:
+        # Packages the streaming reader can't handle go through python-docx
+        file.seek(0)
+    
+    try:
+        from docx import Document
         doc = Document(file)
-        full_text = []
-        for para in doc.paragraphs:
-            full_text.append(para.text)
-        return '\n'.join(full_text)
+        return '\n'.join(para.text for para in doc.paragraphs)
     except Exception as e:
         st.error(f"Error parsing DOCX: {str(e)}")
         return ""
 
-def detect_placeholders_with_ai(text):
-    """Use Gemini AI to intelligently detect placeholders"""
-    if not st.session_state.api_configured or not st.session_state.model_name:
-        st.error("❌ Gemini API not configured properly")
-        return []
+@st.cache_data(show_spinner=False, ttl=UPLOAD_CACHE_TTL)
+def load_text(name, data):
+    """Extract the text of an uploaded file; cached by its name and bytes"""
+    if name.endswith('.docx'):
+        return parse_docx(io.BytesIO(data))
+    return data.decode('utf-8')
+
+def compile_alternation(originals):
+    """One regex matching any of the originals, longest first"""
+    return re.compile('|'.join(map(re.escape, sorted(originals, key=len, reverse=True))))
+
+def locate_placeholders(text, placeholders):
+    """Replace AI-reported positions with real offsets, found in one scan of the text"""
+    occurrences = {}
+    for m in compile_alternation({p['original'] for p in placeholders}).finditer(text):
+        occurrences.setdefault(m.group(0), []).append(m.start())
     
-    try:
-        model = genai.GenerativeModel(st.session_state.model_name)
-        
-        prompt = f"""You are analyzing a legal document to find ALL placeholders that need user input.
+    # Repeated originals take successive occurrences in the order the AI reported them;
+    # ones missing from the text sort last
+    for p in sorted(placeholders, key=lambda x: x['position']):
+        found = occurrences.get(p['original'])
+        p['position'] = found.pop(0) if found else len(text)
 
-DOCUMENT TEXT:
-{text}
+def clean_question(question):
+    """Strip quotes from a generated question and make sure it ends with ?"""
+    question = str(question).strip().strip('"\'')
+    if question and not question.endswith('?'):
+        question += '?'
+    return question
+
+def chunk_text(text):
+    """Split text into overlapping (offset, excerpt) windows for detection"""
+    step = DETECT_CHUNK_SIZE - DETECT_CHUNK_OVERLAP
+    chunks = []
+    for offset in range(0, len(text), step):
+        chunks.append((offset, text[offset:offset + DETECT_CHUNK_SIZE]))
+        if offset + DETECT_CHUNK_SIZE >= len(text):
+            break
+    return chunks
+
+def candidate_regions(text):
+    """(start, end) spans of text around likely placeholders, overlapping spans merged"""
+    regions = []
+    for m in CANDIDATE_RE.finditer(text):
+        start = max(0, m.start() - CANDIDATE_CONTEXT)
+        end = min(len(text), m.end() + CANDIDATE_CONTEXT)
+        if regions and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    return regions
+
+def candidate_excerpts(text):
+    """Pack the regions around likely placeholders into detection excerpts.
+    
+    Returns (excerpt, spans) pairs, spans holding the (excerpt offset, text offset)
+    where each piece of the excerpt starts.
+    """
+    excerpts = []
+    pieces, spans, size = [], [], 0
+    for start, end in candidate_regions(text):
+        # Oversized regions are windowed like a whole document would be
+        for offset, piece in chunk_text(text[start:end]):
+            if pieces and size + len(CANDIDATE_SEP) + len(piece) > DETECT_CHUNK_SIZE:
+                excerpts.append((CANDIDATE_SEP.join(pieces), spans))
+                pieces, spans, size = [], [], 0
+            if pieces:
+                size += len(CANDIDATE_SEP)
+            spans.append((size, start + offset))
+            pieces.append(piece)
+            size += len(piece)
+    if pieces:
+        excerpts.append((CANDIDATE_SEP.join(pieces), spans))
+    return excerpts
+
+def detection_prompt(excerpt):
+    """Prompt asking Gemini for the placeholders in one excerpt"""
+    return f"""You are analyzing a legal document to find ALL placeholders that need user input.
+
+DOCUMENT EXCERPTS (passages around likely placeholders, separated by ---):
+{excerpt}
 
 TASK: Find every placeholder. Look for:
 1. Text in brackets: [Company Name], {{Investor}}, <Date>
@@ -192,6 +564,8 @@ RULES:
 - Ignore very short underscores (under 5 chars)
 - Order by appearance in document
 - Extract clear labels
+- Give each placeholder ONE conversational question (under 20 words, ending with ?)
+  to ask the user for it, with examples if helpful (dates, amounts, states)
 
 OUTPUT (valid JSON only, no markdown):
 {{
@@ -200,71 +574,144 @@ OUTPUT (valid JSON only, no markdown):
       "label": "Company Name",
       "original": "[Company Name]",
       "description": "Legal name of company",
-      "position": 145
+      "position": 145,
+      "question": "What is the company's full legal name?"
     }}
   ]
 }}
 
 Return ONLY the JSON."""
 
-        response = model.generate_content(prompt)
-        ai_text = response.text.strip()
-        
-        # Clean JSON
-        if '```json' in ai_text:
-            ai_text = ai_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in ai_text:
-            ai_text = ai_text.split('```')[1].split('```')[0].strip()
-        
-        result = json.loads(ai_text)
-        
-        placeholders = []
-        seen_labels = set()
-        
-        for item in result.get('placeholders', []):
-            label = item['label'].strip()
-            
-            if label in seen_labels or label.lower() in ['the', 'and', 'or', 'insert', 'a', 'an']:
+def field_category(label, description):
+    """Category of answer a field expects, from its label; None if unclear.
+    
+    The description is only read for a one-word generic label like "Blank"; descriptions
+    mention other fields too often ("date the investor signs") to be trusted otherwise.
+    """
+    text = description if label.strip().lower() in _GENERIC_LABELS else label
+    for category, pattern in _CATEGORY_RES.items():
+        if pattern.search(text):
+            return category
+    return None
+
+def detection_config(excerpt):
+    """DETECT_CONFIG with an output budget for the placeholders the excerpt may hold"""
+    budget = DETECT_TOKENS_PER_CANDIDATE * len(CANDIDATE_RE.findall(excerpt))
+    max_tokens = min(DETECT_MAX_OUTPUT_TOKENS, max(DETECT_CONFIG['max_output_tokens'], budget))
+    return {**DETECT_CONFIG, 'max_output_tokens': max_tokens}
+
+@st.cache_data(show_spinner=False, ttl=UPLOAD_CACHE_TTL)
+def detect_excerpt(excerpt, model_name):
+    """Placeholders Gemini reports in one excerpt; cached per excerpt and model, failures are not"""
+    reply = generate_text(model_name, detection_prompt(excerpt), detection_config(excerpt), parse=json_loads)
+    return reply.get('placeholders', [])
+
+def detect_placeholders(text, model_name):
+    """Ask Gemini for the placeholders in text; returns them with the number of excerpts that failed"""
+    excerpts = candidate_excerpts(text)
+    if not excerpts:
+        # Nothing in the text looks like a placeholder
+        return [], 0
+    
+    # A failed or truncated reply costs only its own excerpt
+    def attempt(excerpt):
+        try:
+            return detect_excerpt(excerpt, model_name)
+        except Exception as e:
+            return e
+    
+    if len(excerpts) == 1:
+        results = [attempt(excerpts[0][0])]
+    else:
+        # Long documents: all windows are sent at once
+        with ThreadPoolExecutor(max_workers=min(len(excerpts), DETECT_MAX_WORKERS)) as executor:
+            results = list(executor.map(attempt, [excerpt for excerpt, _ in excerpts]))
+    
+    failures = [result for result in results if isinstance(result, Exception)]
+    if len(failures) == len(results):
+        raise failures[0]
+    
+    # Positions come back relative to each excerpt; map them through its pieces
+    items = []
+    for (_, spans), found in zip(excerpts, results):
+        if isinstance(found, Exception):
+            continue
+        starts = [excerpt_start for excerpt_start, _ in spans]
+        for item in found:
+            # Items missing what the rest of the app relies on are dropped, not fatal
+            label, original = item.get('label'), item.get('original')
+            if not (isinstance(label, str) and label.strip() and isinstance(original, str) and original):
                 continue
-            
-            seen_labels.add(label)
-            key = re.sub(r'[^a-z0-9]', '_', label.lower())
-            
-            placeholders.append({
-                'key': key,
-                'label': label,
-                'original': item['original'],
-                'description': item.get('description', ''),
-                'value': '',
-                'position': item.get('position', len(placeholders))
-            })
+            position = item.get('position')
+            position = position if isinstance(position, int) and position >= 0 else 0
+            excerpt_start, text_start = spans[max(0, bisect.bisect_right(starts, position) - 1)]
+            item['position'] = text_start + position - excerpt_start
+            items.append(item)
+    
+    placeholders = []
+    seen_labels = set()
+    
+    for item in sorted(items, key=lambda x: x['position']):
+        label = item['label'].strip()
+        
+        if label.lower() in seen_labels or label.lower() in ['the', 'and', 'or', 'insert', 'a', 'an']:
+            continue
         
-        return sorted(placeholders, key=lambda x: x['position'])
+        seen_labels.add(label.lower())
+        key = _LABEL_RE.sub('_', label.lower())
         
+        description = item.get('description') or ''
+        placeholders.append({
+            'key': key,
+            'label': label,
+            'original': item['original'],
+            'description': description,
+            'value': '',
+            'position': item['position'],
+            'question': clean_question(item.get('question') or ''),
+            'category': field_category(label, description)
+        })
+    
+    if placeholders:
+        locate_placeholders(text, placeholders)
+    return sorted(placeholders, key=lambda x: x['position']), len(failures)
+
+def detect_placeholders_with_ai(text):
+    """Use Gemini AI to intelligently detect placeholders; also returns how many excerpts failed"""
+    if not st.session_state.api_configured or not st.session_state.model_name:
+        st.error("❌ Gemini API not configured properly")
+        return [], 0
+    
+    try:
+        return detect_placeholders(text, st.session_state.model_name)
     except Exception as e:
         st.error(f"AI detection failed: {str(e)}")
-        return []
+        return [], 0
 
-def get_ai_question(placeholder, filled_data):
+def placeholder_context(doc_text, placeholder):
+    """Text surrounding a placeholder, for grounding its question"""
+    pos = placeholder['position']
+    if pos >= len(doc_text):
+        return ""
+    return doc_text[max(0, pos - 150):pos + 150]
+
+def get_ai_question(placeholder, filled_data, stream_to=None):
     """Generate contextual question for placeholder"""
     if not st.session_state.api_configured:
         return f"What should I use for {placeholder['label']}?"
     
     try:
-        model = genai.GenerativeModel(st.session_state.model_name)
-        
-        doc_text = st.session_state.document_text
-        pos = doc_text.find(placeholder['original'])
-        if pos >= 0:
-            context_start = max(0, pos - 150)
-            context_end = min(len(doc_text), pos + 150)
-            context = doc_text[context_start:context_end]
+        cache_name = document_cache()
+        if cache_name:
+            context = "the full document is in your cached context"
         else:
-            context = ""
+            context = f"...{placeholder_context(st.session_state.document_text, placeholder)}..."
         
+        # Only the latest answers, so the prompt stays the same size as the session goes on
+        idx = st.session_state.current_index
         filled_info = "\n".join([
             f"- {p['label']}: {filled_data.get(p['key'], 'not filled')}"
-            for p in st.session_state.placeholders[:st.session_state.current_index]
+            for p in st.session_state.placeholders[max(0, idx - FILLED_CONTEXT):idx]
         ]) if filled_data else "This is the first field."
         
         prompt = f"""Generate ONE clear question to ask for this information.
@@ -272,7 +719,7 @@ def get_ai_question(placeholder, filled_data):
 PLACEHOLDER: {placeholder['label']}
 APPEARS AS: {placeholder['original']}
 
-CONTEXT: ...{context}...
+CONTEXT: {context}
 
 FILLED: {filled_info}
 
@@ -288,25 +735,118 @@ EXAMPLES:
 
 Return ONLY the question."""
 
-        response = model.generate_content(prompt)
-        question = response.text.strip().strip('"\'')
-        
-        if not question.endswith('?'):
-            question += '?'
+        question = generate_text(
+            st.session_state.model_name, prompt, QUESTION_CONFIG,
+            cache_name=cache_name, stream_to=stream_to
+        )
         
-        return question
+        return clean_question(question)
         
     except Exception as e:
         return f"What is the {placeholder['label']}?"
 
+def pregenerate_questions(placeholders, doc_text):
+    """Generate the questions for all placeholders in a single Gemini call, keyed by placeholder key"""
+    if not st.session_state.api_configured or not placeholders:
+        return {}
+    
+    try:
+        # With the document cached, the fields need no surrounding text of their own
+        cache_name = document_cache()
+        fields = "\n".join(
+            f"- {p['key']}: {p['label']} (appears as {p['original']})"
+            + ("" if cache_name else f": ...{placeholder_context(doc_text, p)}...")
+            for p in placeholders
+        )
+        
+        prompt = f"""Generate ONE clear question for each field of a legal document.
+
+FIELDS:
+{fields}
+
+RULES:
+1. One question per field, keyed by the field's key, each under 20 words
+2. Include examples if helpful (dates, amounts, states)
+3. Be conversational
+4. End with ?
+
+OUTPUT (valid JSON only, no markdown):
+{{
+  "questions": {{
+    "investor_name": "What is the investor's full legal name?",
+    "purchase_amount": "What amount is being invested? (e.g., $100,000)"
+  }}
+}}
+
+Return ONLY the JSON."""
+
+        result = generate_text(st.session_state.model_name, prompt, QUESTIONS_CONFIG, cache_name=cache_name, parse=json_loads)
+        
+        questions = {}
+        for key, question in result.get('questions', {}).items():
+            question = clean_question(question)
+            if question:
+                questions[key] = question
+        return questions
+        
+    except Exception:
+        return {}
+
+def prefetch_question(placeholder):
+    """Start generating placeholder's question in the background unless it is known or on its way"""
+    key = placeholder['key']
+    if key in st.session_state.questions or key in st.session_state.prefetching:
+        return
+    
+    questions = st.session_state.questions
+    future = submit_in_context(get_ai_question, placeholder, dict(st.session_state.filled_data))
+    future.add_done_callback(lambda f: questions.setdefault(key, f.result()))
+    st.session_state.prefetching[key] = future
+
+def question_for(idx, slot=None):
+    """Question for placeholder idx, asking Gemini only if none was pregenerated or prefetched"""
+    placeholder = st.session_state.placeholders[idx]
+    question = st.session_state.questions.get(placeholder['key'])
+    if question:
+        return question
+    future = st.session_state.prefetching.get(placeholder['key'])
+    if future is not None:
+        return future.result()
+    
+    # A fresh question streams into an assistant bubble in the given st.empty() slot
+    stream_to = slot.chat_message('assistant').empty() if slot is not None else None
+    return get_ai_question(placeholder, st.session_state.filled_data, stream_to)
+
+def real_date(value):
+    """True if a date-shaped answer names a day that exists (not 99/99/99 or Feb 30)"""
+    words = re.split(r'[\s,./-]+', _ORDINAL_RE.sub('', value).strip(' .'))
+    # %b reads three-letter month names in any case
+    text = ' '.join(word[:3] if word.isalpha() else word for word in words)
+    for fmt in _DATE_FORMATS:
+        try:
+            datetime.strptime(text, fmt)
+            return True
+        except ValueError:
+            pass
+    return False
+
+def quick_validate(user_input, placeholder):
+    """Accept obviously well-formed answers locally; None means ask Gemini"""
+    category = placeholder['category']
+    pattern = _QUICK_PATTERNS.get(category)
+    value = user_input.strip()
+    if not pattern or not pattern.fullmatch(value) or _NON_ANSWER_RE.search(value):
+        return None
+    if category == 'date' and not real_date(value):
+        return None
+    return {'valid': True, 'feedback': 'Got it!', 'value': value}
+
 def validate_with_ai(user_input, placeholder, filled_data):
     """Validate user input"""
     if not st.session_state.api_configured:
         return {'valid': True, 'feedback': 'Got it!', 'value': user_input}
     
     try:
-        model = genai.GenerativeModel(st.session_state.model_name)
-        
         prompt = f"""Validate user input for legal document field.
 
 FIELD: {placeholder['label']}
@@ -326,15 +866,7 @@ RULES:
 
 Return ONLY JSON."""
 
-        response = model.generate_content(prompt)
-        ai_text = response.text.strip()
-        
-        if '```json' in ai_text:
-            ai_text = ai_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in ai_text:
-            ai_text = ai_text.split('```')[1].split('```')[0].strip()
-        
-        result = json.loads(ai_text)
+        result = generate_text(st.session_state.model_name, prompt, VALIDATE_CONFIG, parse=json_loads)
         
         return {
             'valid': result.get('valid', True),
@@ -345,20 +877,307 @@ Return ONLY JSON."""
     except:
         return {'valid': True, 'feedback': 'Recorded', 'value': user_input}
 
+def validate_answers_with_ai(entries):
+    """Validate (placeholder, user input) pairs in a single Gemini call, keyed by placeholder key"""
+    verdicts = {p['key']: {'valid': True, 'feedback': 'Got it!', 'value': value} for p, value in entries}
+    if not st.session_state.api_configured or not entries:
+        return verdicts
+    
+    try:
+        fields = "\n".join(f'- {p["key"]}: {p["label"]} = "{value}"' for p, value in entries)
+        
+        prompt = f"""Validate user inputs for legal document fields.
+
+FIELDS:
+{fields}
+
+TASK: Check if each is reasonable. Respond with JSON only (no markdown), keyed by the field's key:
+
+{{
+  "results": {{
+    "investor_name": {{"valid": true/false, "feedback": "Brief message", "value": "cleaned value"}}
+  }}
+}}
+
+RULES:
+- If valid: feedback = "Perfect!" or "Got it!" (1-3 words)
+- If invalid: feedback = clarification question (under 15 words)
+
+Return ONLY JSON."""
+
+        results = generate_text(st.session_state.model_name, prompt, ANSWERS_CONFIG, parse=json_loads).get('results', {})
+        for key, verdict in verdicts.items():
+            result = results.get(key) or {}
+            verdict.update(
+                valid=result.get('valid', True),
+                feedback=result.get('feedback', 'Recorded'),
+                value=result.get('value', verdict['value'])
+            )
+    except Exception:
+        pass
+    
+    return verdicts
+
+def parse_answers(name, data):
+    """Read a JSON object or two-column CSV of answers, keyed by lowercased field key or label"""
+    if name.endswith('.json'):
+        answers = json_loads(data)
+        if not isinstance(answers, dict):
+            raise ValueError("expected a JSON object of field: answer")
+        rows = answers.items()
+    else:
+        rows = (row[:2] for row in csv.reader(io.StringIO(data.decode('utf-8-sig'))) if len(row) >= 2)
+    return {str(field).strip().lower(): str(value).strip() for field, value in rows if str(value).strip()}
+
+def next_open(start):
+    """Index of the first field from start on that has no answer yet; past the end if all do"""
+    placeholders = st.session_state.placeholders
+    filled_data = st.session_state.filled_data
+    while start < len(placeholders) and placeholders[start]['key'] in filled_data:
+        start += 1
+    return start
+
+def apply_answers(answers, source):
+    """Fill every remaining field the supplied answers cover; the chat then asks only for the rest"""
+    entries = []
+    for p in st.session_state.placeholders[st.session_state.current_index:]:
+        if p['key'] in st.session_state.filled_data:
+            continue
+        value = answers.get(p['key'].lower(), answers.get(p['label'].lower()))
+        if value is not None:
+            entries.append((p, value))
+    
+    # Answers the local checks accept don't need Gemini; the rest share one call
+    verdicts = {}
+    unsure = []
+    for p, value in entries:
+        val = quick_validate(value, p)
+        if val is None:
+            unsure.append((p, value))
+        else:
+            verdicts[p['key']] = val
+    verdicts.update(validate_answers_with_ai(unsure))
+    
+    filled = 0
+    for key, verdict in verdicts.items():
+        if verdict['valid']:
+            st.session_state.filled_data[key] = verdict['value']
+            filled += 1
+    st.session_state.current_index = next_open(st.session_state.current_index)
+    
+    summary = f"Filled {filled} field{'s' * (filled != 1)} from {source}."
+    if st.session_state.current_index >= len(st.session_state.placeholders):
+        add_message('assistant', f"{summary} All done! 🎉")
+        st.session_state.step = 'complete'
+        return
+    
+    # A rejected answer for the field up next gets its clarification instead of the plain question
+    current = st.session_state.placeholders[st.session_state.current_index]
+    verdict = verdicts.get(current['key'])
+    if verdict is not None:
+        add_message('assistant', f"{summary}\n\n{verdict['feedback']}")
+    else:
+        add_message('assistant', f"{summary}\n\n{question_for(st.session_state.current_index)}")
+
+@st.cache_data(show_spinner=False, ttl=UPLOAD_CACHE_TTL)
+def fill_document(document_text, replacements, spliced=()):
+    """Substitute (original, value) pairs into the document in a single pass.
+    
+    An original paired with None is shared by several fields: only the occurrences whose
+    start appears in the (position, value) pairs of spliced are replaced.
+    """
+    mapping = dict(replacements)
+    if not mapping:
+        return document_text
+    at = dict(spliced)
+    
+    def value_for(start, original):
+        value = mapping[original]
+        return value if value is not None else at.get(start, original)
+    
+    if ahocorasick is None:
+        return compile_alternation(mapping).sub(lambda m: value_for(m.start(), m.group(0)), document_text)
+    
+    automaton = ahocorasick.Automaton()
+    for original in mapping:
+        automaton.add_word(original, original)
+    automaton.make_automaton()
+    
+    # Keep leftmost-longest matches, same as the longest-first alternation
+    # (iter_long drops a match left pending at the end of the text)
+    matches = sorted((end - len(original) + 1, -len(original), original) for end, original in automaton.iter(document_text))
+    parts = []
+    last = 0
+    for start, neg_length, original in matches:
+        if start < last:
+            continue
+        parts.append(document_text[last:start])
+        parts.append(value_for(start, original))
+        last = start - neg_length
+    parts.append(document_text[last:])
+    return ''.join(parts)
+
+def placeholder_columns(placeholders):
+    """Column-wise copy of the placeholder fields read on every rerun"""
+    return {field: [p[field] for p in placeholders] for field in ('key', 'label', 'original', 'position')}
+
 def generate_completed_document():
     """Generate final document"""
-    completed = st.session_state.document_text
-    for p in st.session_state.placeholders:
-        value = st.session_state.filled_data.get(p['key'], p['original'])
-        completed = completed.replace(p['original'], value)
-    return completed
+    columns = st.session_state.placeholder_columns
+    filled_data = st.session_state.filled_data
+    
+    # An original used by one field is replaced everywhere; one shared by several fields
+    # (blank lines, say) is replaced field by field at the offset each was located at
+    keys = {}
+    for key, original in zip(columns['key'], columns['original']):
+        keys.setdefault(original, set()).add(key)
+    
+    # Unfilled placeholders would map to themselves, so leave them out of the pattern
+    mapping = {}
+    spliced = []
+    for key, original, position in zip(columns['key'], columns['original'], columns['position']):
+        if key not in filled_data:
+            continue
+        if len(keys[original]) == 1:
+            mapping[original] = filled_data[key]
+        else:
+            mapping[original] = None
+            spliced.append((position, filled_data[key]))
+    return fill_document(st.session_state.document_text, tuple(mapping.items()), tuple(spliced))
+
+@st.cache_data(show_spinner=False, ttl=UPLOAD_CACHE_TTL)
+def build_docx_bytes(text):
+    """Serialize text as a DOCX, one paragraph per line"""
+    from docx import Document
+    doc = Document()
+    for line in text.splitlines():
+        doc.add_paragraph(line)
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+def add_message(msg_type, content):
+    """Record a chat message"""
+    st.session_state.messages.append({'type': msg_type, 'content': content})
 
 def reset_app():
     """Reset all state"""
+    if st.session_state.doc_cache:
+        delete_document_cache(st.session_state.doc_cache)
     for key in list(st.session_state.keys()):
         del st.session_state[key]
     st.rerun()
 
+@st.fragment
+def chat_fragment():
+    """Chat panel; reruns on its own so a turn skips the rest of the page"""
+    col1, col2 = st.columns([2, 1])
+    
+    with col1:
+        st.markdown("### 💬 Fill Details")
+        
+        # Progress and history are filled in after the input is handled,
+        # so a submitted turn shows up without another rerun
+        progress_area = st.container()
+        st.markdown("---")
+        history = st.container()
+        pending = st.empty()
+        st.markdown("---")
+        
+        # Input
+        if st.session_state.current_index < len(st.session_state.placeholders):
+            with st.form(key='chat', clear_on_submit=True):
+                user_input = st.text_input("Answer:", placeholder="Type here...")
+                submitted = st.form_submit_button("Send")
+                
+                if submitted and user_input.strip():
+                    add_message('user', user_input.strip())
+                    
+                    current = st.session_state.placeholders[st.session_state.current_index]
+                    
+                    val = quick_validate(user_input, current)
+                    if val is None:
+                        # Ask for the next question while Gemini validates this answer
+                        next_index = next_open(st.session_state.current_index + 1)
+                        if next_index < len(st.session_state.placeholders):
+                            prefetch_question(st.session_state.placeholders[next_index])
+                        
+                        with st.spinner("Validating..."):
+                            val = validate_with_ai(user_input.strip(), current, st.session_state.filled_data)
+                    
+                    if val['valid']:
+                        st.session_state.filled_data[current['key']] = val['value']
+                        st.session_state.current_index = next_open(st.session_state.current_index + 1)
+                        
+                        if st.session_state.current_index >= len(st.session_state.placeholders):
+                            add_message('assistant', f"{val['feedback']} All done! 🎉")
+                            st.session_state.step = 'complete'
+                        else:
+                            next_q = question_for(st.session_state.current_index, pending)
+                            pending.empty()
+                            
+                            add_message('assistant', f"{val['feedback']}\n\n{next_q}")
+                    else:
+                        add_message('assistant', val['feedback'])
+                    
+                    if st.session_state.step == 'complete':
+                        st.rerun(scope='app')
+            
+            # Bulk answers: validated together instead of one chat turn per field
+            with st.expander("📥 Fill from a JSON or CSV of answers"):
+                with st.form(key='answers', clear_on_submit=True):
+                    answers_file = st.file_uploader("Answers", type=['json', 'csv'], label_visibility="collapsed")
+                    if st.form_submit_button("Apply") and answers_file is not None:
+                        try:
+                            answers = parse_answers(answers_file.name, answers_file.getvalue())
+                        except (ValueError, csv.Error) as e:
+                            st.error(f"Couldn't read answers: {str(e)}")
+                        else:
+                            with st.spinner("Validating answers..."):
+                                apply_answers(answers, answers_file.name)
+                            if st.session_state.step == 'complete':
+                                st.rerun(scope='app')
+        
+        # Generate the next few questions while the user types this answer
+        upcoming = [
+            p for p in st.session_state.placeholders[st.session_state.current_index + 1:]
+            if p['key'] not in st.session_state.filled_data
+        ]
+        for placeholder in upcoming[:PREFETCH_AHEAD]:
+            prefetch_question(placeholder)
+        
+        # Progress lives in the fragment; the sidebar isn't redrawn on a chat turn
+        with progress_area:
+            total = len(st.session_state.placeholders)
+            done = len(st.session_state.filled_data)
+            st.progress(done / total)
+            total_col, done_col, left_col = st.columns(3)
+            total_col.metric("Total", total)
+            done_col.metric("Done", done)
+            left_col.metric("Left", total - done)
+        
+        # Messages
+        with history:
+            for msg in st.session_state.messages:
+                with st.chat_message(msg['type']):
+                    st.markdown(msg['content'])
+    
+    with col2:
+        st.markdown("### 📋 Fields")
+        
+        columns = st.session_state.placeholder_columns
+        filled_data = st.session_state.filled_data
+        current = st.session_state.current_index
+        st.dataframe({
+            'Status': [
+                "✅" if key in filled_data else "▶️" if i == current else "⭕"
+                for i, key in enumerate(columns['key'])
+            ],
+            'Field': columns['label'],
+            'Value': [filled_data.get(key, '') for key in columns['key']]
+        }, hide_index=True)
+
+
 # Check API
 if not GEMINI_API_KEY:
     st.error("⚠️ No API key found! Add GEMINI_API_KEY to .env file")
@@ -381,36 +1200,40 @@ if st.session_state.step == 'upload':
     
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        st.markdown("""
-        <div class="upload-section">
-            <h2>📤 Upload Document</h2>
-            <p>AI will identify all placeholders</p>
-        </div>
-        """, unsafe_allow_html=True)
+        st.html(UPLOAD_BANNER)
         
         uploaded_file = st.file_uploader("Choose file", type=['txt', 'docx'])
         
         if uploaded_file:
             with st.spinner("🤖 Analyzing..."):
-                if uploaded_file.name.endswith('.docx'):
-                    text = parse_docx(uploaded_file)
-                else:
-                    text = uploaded_file.read().decode('utf-8')
+                text = load_text(uploaded_file.name, uploaded_file.getvalue())
                 
                 if text:
                     st.session_state.document_text = text
                     st.session_state.file_name = uploaded_file.name
                     
-                    placeholders = detect_placeholders_with_ai(text)
+                    placeholders, failed = detect_placeholders_with_ai(text)
                     
                     if placeholders:
+                        cache_document(text)
                         st.session_state.placeholders = placeholders
-                        first_q = get_ai_question(placeholders[0], {})
+                        st.session_state.placeholder_columns = placeholder_columns(placeholders)
+                        
+                        # Detection already wrote a question per field; batch any it skipped
+                        questions = {p['key']: p['question'] for p in placeholders if p['question']}
+                        missing = [p for p in placeholders if not p['question']]
+                        if missing:
+                            questions.update(pregenerate_questions(missing, text))
+                        st.session_state.questions = questions
                         
-                        st.session_state.messages = [{
-                            'type': 'assistant',
-                            'content': f"Found {len(placeholders)} fields!\n\n{first_q}"
-                        }]
+                        live = st.empty()
+                        first_q = question_for(0, live)
+                        live.empty()
+                        
+                        found = f"Found {len(placeholders)} fields!"
+                        if failed:
+                            found += " ⚠️ Part of the document couldn't be analyzed, so some fields may be missing."
+                        add_message('assistant', f"{found}\n\n{first_q}")
                         st.session_state.step = 'chat'
                         st.rerun()
                     else:
@@ -418,90 +1241,7 @@ if st.session_state.step == 'upload':
 
 # CHAT
 elif st.session_state.step == 'chat':
-    col1, col2 = st.columns([2, 1])
-    
-    with col1:
-        st.markdown("### 💬 Fill Details")
-        
-        progress = st.session_state.current_index / len(st.session_state.placeholders)
-        st.progress(progress)
-        st.caption(f"{st.session_state.current_index}/{len(st.session_state.placeholders)} done")
-        st.markdown("---")
-        
-        # Messages
-        for msg in st.session_state.messages:
-            if msg['type'] == 'user':
-                st.markdown(f'<div class="chat-message user-message"><strong>You:</strong> {msg["content"]}</div>', 
-                          unsafe_allow_html=True)
-            else:
-                st.markdown(f'<div class="chat-message assistant-message"><strong>AI:</strong> {msg["content"]}</div>', 
-                          unsafe_allow_html=True)
-        
-        st.markdown("---")
-        
-        # Input
-        if st.session_state.current_index < len(st.session_state.placeholders):
-            with st.form(key='chat', clear_on_submit=True):
-                user_input = st.text_input("Answer:", placeholder="Type here...")
-                submitted = st.form_submit_button("Send")
-                
-                if submitted and user_input.strip():
-                    st.session_state.messages.append({
-                        'type': 'user',
-                        'content': user_input.strip()
-                    })
-                    
-                    current = st.session_state.placeholders[st.session_state.current_index]
-                    
-                    with st.spinner("Validating..."):
-                        val = validate_with_ai(user_input.strip(), current, st.session_state.filled_data)
-                    
-                    if val['valid']:
-                        st.session_state.filled_data[current['key']] = val['value']
-                        st.session_state.current_index += 1
-                        
-                        if st.session_state.current_index >= len(st.session_state.placeholders):
-                            st.session_state.messages.append({
-                                'type': 'assistant',
-                                'content': f"{val['feedback']} All done! 🎉"
-                            })
-                            st.session_state.step = 'complete'
-                        else:
-                            next_p = st.session_state.placeholders[st.session_state.current_index]
-                            next_q = get_ai_question(next_p, st.session_state.filled_data)
-                            
-                            st.session_state.messages.append({
-                                'type': 'assistant',
-                                'content': f"{val['feedback']}\n\n{next_q}"
-                            })
-                    else:
-                        st.session_state.messages.append({
-                            'type': 'assistant',
-                            'content': val['feedback']
-                        })
-                    
-                    st.rerun()
-    
-    with col2:
-        st.markdown("### 📋 Fields")
-        
-        for idx, p in enumerate(st.session_state.placeholders):
-            if idx < st.session_state.current_index:
-                status = "completed"
-                icon = "✅"
-                value = st.session_state.filled_data.get(p['key'], '')
-                display = f"<br><small><i>{value}</i></small>"
-            elif idx == st.session_state.current_index:
-                status = "current"
-                icon = "▶️"
-                display = ""
-            else:
-                status = "pending"
-                icon = "⭕"
-                display = ""
-            
-            st.markdown(f'<div class="placeholder-box {status}">{icon} <strong>{p["label"]}</strong>{display}</div>', 
-                       unsafe_allow_html=True)
+    chat_fragment()
 
 # COMPLETE
 elif st.session_state.step == 'complete':
@@ -509,21 +1249,15 @@ elif st.session_state.step == 'complete':
     
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        st.markdown("""
-        <div class="success-box">
-            <h1>✅ Complete!</h1>
-            <p>Your document is ready</p>
-        </div>
-        """, unsafe_allow_html=True)
+        st.html(SUCCESS_BANNER)
     
     st.markdown("<br>", unsafe_allow_html=True)
     
     with st.spinner("Generating..."):
-        if not st.session_state.completed_doc:
-            st.session_state.completed_doc = generate_completed_document()
+        completed_doc = generate_completed_document()
     
     st.markdown("### 📄 Preview")
-    st.markdown(f'<div class="doc-preview">{st.session_state.completed_doc}</div>', unsafe_allow_html=True)
+    st.markdown(f'<div class="doc-preview">{completed_doc}</div>', unsafe_allow_html=True)
     
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -532,21 +1266,15 @@ elif st.session_state.step == 'complete':
     with col1:
         st.download_button(
             "📥 Download TXT",
-            data=st.session_state.completed_doc,
+            data=completed_doc,
             file_name=f"completed_{st.session_state.file_name.replace('.docx', '.txt')}",
             mime="text/plain"
         )
     
     with col2:
-        doc = Document()
-        for line in st.session_state.completed_doc.split('\n'):
-            doc.add_paragraph(line)
-        bio = io.BytesIO()
-        doc.save(bio)
-        
         st.download_button(
             "📥 Download DOCX",
-            data=bio.getvalue(),
+            data=build_docx_bytes(completed_doc),
             file_name=f"completed_{st.session_state.file_name}",
             mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         )
@@ -563,13 +1291,5 @@ with st.sidebar:
     else:
         st.error("❌ Not Connected")
     
-    st.markdown("---")
-    
-    if st.session_state.placeholders:
-        st.markdown("### 📊 Progress")
-        st.metric("Total", len(st.session_state.placeholders))
-        st.metric("Done", len(st.session_state.filled_data))
-        st.metric("Left", len(st.session_state.placeholders) - len(st.session_state.filled_data))
-    
     st.markdown("---")
     st.info("AI-powered with Google Gemini")